@@ -0,0 +1,279 @@
+import json
+from datetime import datetime, timedelta
+
+from conversation import cached_results, remember_results, history
+from report_context import assemble_passages
+
+# ------------------------------------------------------
+#        retrieval and prompt assembly per assistant
+# ------------------------------------------------------
+#
+# Shared by start.py and loadtest.py, so the load test runs the same searches
+# and builds the same prompts as the app. Prompts are (role, content) pairs,
+# callers turn them into the message type of their chat model.
+
+model_id = ".elser_model_1"
+INDICES = {
+    'Transaction analyser': 'search-transactions',
+    'Customer support': 'search-customer-support',
+    'Report analyser': 'search-annual-reports'
+}
+CAMPAIGN_INDEX = 'search-campaigns'
+
+
+def report_analyser_search_operation(es, index, question, report_name):
+    query = {
+        "bool": {
+            "should": [
+                {
+                    "text_expansion": {
+                        "ml.inference.text_expanded.predicted_value": {
+                            "model_id": model_id,
+                            "model_text": question
+                        }
+                    }
+                },
+                {
+                    "match": {
+                        "text": question
+                    }
+                }
+            ],
+            "filter": {
+                "term": {
+                    "report_name": report_name
+                }
+            }
+        }
+    }
+
+    field_list = ['page', 'section', 'import_mode', 'text', '_score']
+    results = es.search(index=index, query=query, size=20, fields=field_list)
+    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in results["hits"]["hits"]]
+    documents = []
+    # Check if there are hits
+    if "hits" in results and "total" in results["hits"]:
+        total_hits = results["hits"]["total"]
+        # Check if there are any hits with a value greater than 0
+        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
+            for hit in response_data:
+                if hit['_score'] > 5:
+                    doc_data = {field: hit[field] for field in field_list if field in hit}
+                    documents.append(doc_data)
+    return documents
+
+
+def customer_support_search_operation(es, support_index, index, question):
+    if support_index is not None:
+        documents, confident = support_index.search(question)
+        # only low confidence questions go on to the ELSER hybrid query
+        if confident:
+            return documents
+    expansion_query = {
+        "bool": {
+            "should": [
+                {
+                    "text_expansion": {
+                        "ml.inference.body_content_expanded.predicted_value": {
+                            "model_id": model_id,
+                            "model_text": question
+                        }
+                    }
+                },
+                {
+                    "match": {
+                        "body_content": question
+                    }
+                }
+            ]
+        }
+    }
+    field_list = ['title', 'body_content', '_score']
+    results = es.search(index=index, query=expansion_query, size=20, fields=field_list)
+    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in results["hits"]["hits"]]
+    documents = []
+    # Check if there are hits
+    if "hits" in results and "total" in results["hits"]:
+        total_hits = results["hits"]["total"]
+
+        # Check if there are any hits with a value greater than 0
+        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
+            for hit in response_data:
+                if hit['_score'] > 0:
+                    doc_data = {field: hit[field] for field in field_list if field in hit}
+                    documents.append(doc_data)
+    return documents
+
+
+def transaction_search_operation(es, index, question, days):
+    set_range_date = datetime.now() - timedelta(days=days)
+    query = {
+        "bool": {
+            "should": [
+                {
+                    "text_expansion": {
+                        "ml.inference.description_expanded.predicted_value": {
+                            "model_id": model_id,
+                            "model_text": question
+                        }
+                    }
+                },
+                {
+                    "match": {
+                        "description": question
+                    }
+                }
+            ],
+            "filter": [
+                {
+                    "range": {
+                        "transaction_date": {
+                            "gte": set_range_date
+                        }
+                    }
+                }
+            ]
+        }
+    }
+    field_list = ['transaction_date', 'account_number', 'balance', 'description', 'transaction_type', 'value', 'entity',
+                  '_score']
+    results = es.search(index=index, query=query, size=100, fields=field_list)
+
+
+    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in results["hits"]["hits"]]
+    documents = []
+    # Check if there are hits
+    if "hits" in results and "total" in results["hits"]:
+        total_hits = results["hits"]["total"]
+
+        # Check if there are any hits with a value greater than 0
+        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
+            for hit in response_data:
+                if hit['_score'] > 0:
+                    doc_data = {field: hit[field] for field in field_list if field in hit}
+                    documents.append(doc_data)
+    return documents
+
+
+def get_campaigns(es, index, text):
+    expansion_query = {
+        "bool": {
+            "should": [
+                {
+                    "text_expansion": {
+                        "ml.inference.campaign_description_expanded.predicted_value": {
+                            "model_id": model_id,
+                            "model_text": text
+                        }
+                    },
+                    "text_expansion": {
+                        "ml.inference.campaign_name_expanded.predicted_value": {
+                            "model_id": model_id,
+                            "model_text": text
+                        }
+                    }
+                },
+                {
+                    "match": {
+                        "campaign_description": {
+                            "query": text,
+                            "boost": 1
+                        }
+                    },
+                    "match": {
+                        "campaign_name": {
+                            "query": text,
+                            "boost": 1
+                        }
+                    }
+                }
+            ]
+        }
+    }
+
+    field_list = ['campaign_name', 'campaign_description', '_score']
+    campaign_results = es.search(index=index, query=expansion_query, size=1, fields=field_list)
+    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in campaign_results["hits"]["hits"]]
+    documents = []
+    # Check if there are hits
+    if "hits" in campaign_results and "total" in campaign_results["hits"]:
+        total_hits = campaign_results["hits"]["total"]
+
+        # Check if there are any hits with a value greater than 0
+        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
+            for hit in response_data:
+                if hit['_score'] > 5:
+                    doc_data = {field: hit[field] for field in field_list if field in hit}
+                    documents.append(doc_data)
+    return documents
+
+
+def truncate_text(text, max_tokens):
+    tokens = text.split()
+    return ' '.join(tokens[:max_tokens])
+
+
+def retrieve(es, support_index, conversation, assistant_type, question, days=None, report_name=None):
+    """Returns the results for a question and whether they were reused from the previous search."""
+    index = INDICES[assistant_type]
+    if assistant_type == 'Transaction analyser':
+        filters = (assistant_type, days)
+        results = cached_results(conversation, filters, question)
+        reused_results = results is not None
+        if not reused_results:
+            results = transaction_search_operation(es, index, question, days)
+            remember_results(conversation, filters, results, question)
+    elif assistant_type == 'Customer support':
+        filters = (assistant_type,)
+        # support search has no filters besides the question, so every question retrieves its own articles
+        reused_results = False
+        results = customer_support_search_operation(es, support_index, index, question)
+        remember_results(conversation, filters, results, question)
+    else:
+        filters = (assistant_type, report_name)
+        results = cached_results(conversation, filters, question)
+        reused_results = results is not None
+        if not reused_results:
+            sections = report_analyser_search_operation(es, index, question, report_name)
+            # drop sections indexed twice and join neighbouring sections of a page into one passage
+            results = assemble_passages(sections)
+            remember_results(conversation, filters, results, question)
+    return results, reused_results
+
+
+def build_prompt(conversation, assistant_type, question, results):
+    string_results = json.dumps(results)
+    if assistant_type == 'Transaction analyser':
+        augmented_prompt = f"""Using only the contexts below, answer the query.
+        Contexts: {string_results}
+
+        Query: {question}"""
+        system = ("You are a helpful financial analyst using transaction search results to give advice to customers. "
+                  "If you can asnwer a question, attempt to answer it fully. Assume the context provided provides an accurate response to the query.")
+    elif assistant_type == 'Customer support':
+        string_results = truncate_text(string_results, 10000)
+        augmented_prompt = f"""Using only the context below, answer the query.
+        Context: {string_results}
+
+        Query: {question}"""
+        system = ("You are a helpful customer support agent that answers questions based only on the context provided. "
+                  "When you respond, please cite your source.")
+    else:
+        reduced_string_results = truncate_text(string_results, 8000)
+        augmented_prompt = f"""Using only the context below, answer the query.
+        Context: {reduced_string_results}
+
+        Query: {question}"""
+        system = ("You are a helpful analyst that answers questions based only on the context provided. "
+                  "When you respond, please cite your source and where possible, always summarise your answers.")
+    return [("system", system), *history(conversation), ("human", augmented_prompt)]
+
+
+def campaign_prompt(campaigns):
+    campaign_string_results = json.dumps(campaigns)
+    augmented_prompt = f"""Using the contexts below, explain to the customer about our special offers.
+                Contexts: {campaign_string_results}"""
+    system = ("You are a helpful customer support representative that can enthusiastically explain how our special offers can help them. "
+              "Do not simply repeat the special offer text, rephrase it to be positive and rewarding."
+              "Respond in no more than 80 words.")
+    return [("system", system), ("human", augmented_prompt)]
@@ -0,0 +1,156 @@
+import math
+from functools import lru_cache
+
+from profiler import lazy_import
+from support_index import tokenize
+
+# ------------------------------------------
+#        per-session conversation store
+# ------------------------------------------
+
+# token budget for the conversation history that is replayed to the LLM
+HISTORY_TOKEN_BUDGET = 1500
+# number of recent turns kept verbatim while they fit the budget, the latest turn is never compacted
+RECENT_TURNS = 3
+# share of a follow-up's terms that must appear in the questions behind the cached results to reuse them
+RELATED_QUESTION_OVERLAP = 0.5
+# maximum words kept from an answer when it is compacted into the summary
+SUMMARY_WORDS = 40
+
+
+# count tokens from words instead of loading tiktoken, set by approximate_tokens()
+APPROXIMATE_TOKENS = False
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name="cl100k_base"):
+    # tiktoken is only loaded the first time something needs counting. A failed load raises and is not
+    # cached, so the next call tries again.
+    return lazy_import('tiktoken').get_encoding(encoding_name)
+
+
+def approximate_tokens():
+    # for offline tools such as the load test, the app itself always counts with tiktoken
+    global APPROXIMATE_TOKENS
+    APPROXIMATE_TOKENS = True
+
+
+def num_tokens(text, encoding_name="cl100k_base"):
+    if APPROXIMATE_TOKENS:
+        # English text averages about four tokens for every three words
+        return math.ceil(len(text.split()) * 4 / 3)
+    return len(get_encoding(encoding_name).encode(text))
+
+
+def new_conversation():
+    return {
+        "filters": None,
+        "results": None,
+        "result_terms": set(),
+        "summary": [],
+        "turns": []
+    }
+
+
+def get_conversation(session_state):
+    if "conversation" not in session_state:
+        session_state.conversation = new_conversation()
+    return session_state.conversation
+
+
+def reset_conversation(session_state):
+    session_state.conversation = new_conversation()
+    return session_state.conversation
+
+
+def is_related(conversation, question):
+    terms = set(tokenize(question))
+    if not terms:
+        # questions like "why?" or "tell me more" refer back to the previous answer
+        return True
+    return len(terms & conversation["result_terms"]) / len(terms) >= RELATED_QUESTION_OVERLAP
+
+
+def cached_results(conversation, filters, question):
+    # only reuse the last result set when the search filters have not changed and the question stays on topic
+    if conversation["results"] is None or conversation["filters"] != filters:
+        return None
+    if not is_related(conversation, question):
+        return None
+    conversation["result_terms"] |= set(tokenize(question))
+    return conversation["results"]
+
+
+def remember_results(conversation, filters, results, question):
+    if conversation["filters"] != filters:
+        # the user moved on to different data, earlier turns no longer apply
+        conversation["summary"] = []
+        conversation["turns"] = []
+    conversation["filters"] = filters
+    conversation["results"] = results
+    conversation["result_terms"] = set(tokenize(question))
+
+
+def summarise_turn(turn):
+    words = turn["answer"].split()
+    answer = ' '.join(words[:SUMMARY_WORDS])
+    if len(words) > SUMMARY_WORDS:
+        answer += '...'
+    return f"Q: {turn['question']} A: {answer}"
+
+
+def truncate_tokens(text, max_tokens):
+    if num_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    # binary search for the most words that fit, the trailing marker included
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if num_tokens(' '.join(words[:middle]) + '...') <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    if low == 0:
+        return '...' if num_tokens('...') <= max_tokens else ''
+    return ' '.join(words[:low]) + '...'
+
+
+def history_tokens(conversation):
+    total = sum(num_tokens(line) for line in conversation["summary"])
+    for turn in conversation["turns"]:
+        total += num_tokens(turn["question"]) + num_tokens(turn["answer"])
+    return total
+
+
+def compact(conversation, budget=HISTORY_TOKEN_BUDGET):
+    # fold the oldest turns into one line summaries until the history fits the budget
+    while len(conversation["turns"]) > RECENT_TURNS or (
+            len(conversation["turns"]) > 1 and history_tokens(conversation) > budget):
+        oldest = conversation["turns"].pop(0)
+        conversation["summary"].append(summarise_turn(oldest))
+    # if the summaries alone are still too large, drop the oldest ones
+    while conversation["summary"] and history_tokens(conversation) > budget:
+        conversation["summary"].pop(0)
+    # the latest turn is kept, but cut down when it is over the budget on its own
+    if conversation["turns"] and history_tokens(conversation) > budget:
+        turn = conversation["turns"][-1]
+        turn["question"] = truncate_tokens(turn["question"], budget // 2)
+        turn["answer"] = truncate_tokens(turn["answer"], budget - num_tokens(turn["question"]))
+
+
+def add_turn(conversation, question, answer, budget=HISTORY_TOKEN_BUDGET):
+    conversation["turns"].append({"question": question, "answer": answer})
+    compact(conversation, budget)
+
+
+def history(conversation):
+    # returns (role, content) pairs, oldest first, ready to be turned into chat messages
+    messages = []
+    if conversation["summary"]:
+        summary = '\n'.join(conversation["summary"])
+        messages.append(("system", f"Summary of the earlier conversation:\n{summary}"))
+    for turn in conversation["turns"]:
+        messages.append(("human", turn["question"]))
+        messages.append(("ai", turn["answer"]))
+    return messages
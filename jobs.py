@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# ------------------------------------------
+#        background ingestion jobs
+# ------------------------------------------
+
+JOBS_DIR = '.jobs'
+MAX_WORKERS = 2
+# seconds between status refreshes while a page has active jobs
+POLL_SECONDS = 2
+ACTIVE = ('queued', 'running', 'interrupted')
+# finished job records kept on disk, older ones are deleted when a new job is submitted
+MAX_FINISHED_JOBS = 50
+
+
+class Job:
+    """Handle passed to a job handler to read its parameters and files and to save progress."""
+
+    def __init__(self, runner, record):
+        self._runner = runner
+        self.id = record["id"]
+        self.params = record["params"]
+        self.checkpoint = dict(record["checkpoint"])
+
+    def path(self, name):
+        return self._runner.job_path(self.id, name)
+
+    def set_total(self, total):
+        self._runner._update(self.id, total=total)
+
+    def save_checkpoint(self, done, **values):
+        # called after a unit of work is durable, a resumed job starts from the last checkpoint
+        self.checkpoint.update(values)
+        self._runner._update(self.id, done=done, checkpoint=dict(self.checkpoint))
+
+
+class JobRunner:
+    """Runs ingestion jobs on a bounded thread pool, independent of Streamlit script runs.
+
+    Job records are written to disk after every checkpoint. Jobs that were queued
+    or running when the process stopped are marked interrupted and resume from
+    their checkpoint once a handler for their kind is registered. Failed jobs
+    keep their files so they can be retried from their checkpoint. When a job
+    completes its files are deleted and only the record is kept, up to
+    MAX_FINISHED_JOBS finished records in total.
+    """
+
+    def __init__(self, directory=JOBS_DIR, max_workers=MAX_WORKERS):
+        self.directory = directory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingestion')
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._jobs = {}
+        os.makedirs(directory, exist_ok=True)
+        for job_id in os.listdir(directory):
+            record_path = os.path.join(directory, job_id, 'job.json')
+            if not os.path.exists(record_path):
+                continue
+            with open(record_path) as record_file:
+                record = json.load(record_file)
+            if record["status"] in ('queued', 'running'):
+                record["status"] = 'interrupted'
+            self._jobs[job_id] = record
+
+    def job_path(self, job_id, name):
+        return os.path.join(self.directory, job_id, name)
+
+    def _save(self, record):
+        record_path = os.path.join(self.directory, record["id"], 'job.json')
+        with open(record_path + '.tmp', 'w') as record_file:
+            json.dump(record, record_file)
+        os.replace(record_path + '.tmp', record_path)
+
+    def _update(self, job_id, **values):
+        with self._lock:
+            record = self._jobs[job_id]
+            record.update(values)
+            record["updated_at"] = time.time()
+            self._save(record)
+
+    def register(self, kind, handler):
+        # pages register their handlers on every run, interrupted jobs are resumed only once
+        with self._lock:
+            self._handlers[kind] = handler
+            resume = [record for record in self._jobs.values()
+                      if record["kind"] == kind and record["status"] == 'interrupted']
+            for record in resume:
+                record["status"] = 'queued'
+                self._save(record)
+        for record in resume:
+            self._executor.submit(self._run, record["id"])
+
+    def _remove_files(self, job_id):
+        job_dir = os.path.join(self.directory, job_id)
+        for name in os.listdir(job_dir):
+            if name != 'job.json':
+                os.remove(os.path.join(job_dir, name))
+
+    def _prune(self):
+        with self._lock:
+            finished = sorted((record for record in self._jobs.values() if record["status"] not in ACTIVE),
+                              key=lambda item: item["created_at"])
+            expired = finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]
+            for record in expired:
+                del self._jobs[record["id"]]
+        for record in expired:
+            shutil.rmtree(os.path.join(self.directory, record["id"]), ignore_errors=True)
+
+    def submit(self, kind, params, files=None):
+        self._prune()
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.directory, job_id))
+        for name, content in (files or {}).items():
+            with open(os.path.join(self.directory, job_id, name), 'wb') as job_file:
+                job_file.write(content)
+        record = {"id": job_id, "kind": kind, "params": params, "status": 'queued', "checkpoint": {},
+                  "done": 0,
+                  "total": None, "error": None, "created_at": time.time(), "updated_at": time.time(),
+                  "started_at": None, "done_at_start": 0}
+        with self._lock:
+            self._jobs[job_id] = record
+            self._save(record)
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def retry(self, job_id):
+        # a failed job keeps its files and checkpoint, so it continues where it stopped
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None or record["status"] != 'failed' or record["kind"] not in self._handlers:
+                return False
+            record.update(status='queued', error=None, updated_at=time.time())
+            self._save(record)
+        self._executor.submit(self._run, job_id)
+        return True
+
+    def _run(self, job_id):
+        with self._lock:
+            record = self._jobs[job_id]
+            handler = self._handlers[record["kind"]]
+        self._update(job_id, status='running', started_at=time.time(), done_at_start=record["done"])
+        try:
+            handler(Job(self, record))
+        except Exception:
+            self._update(job_id, status='failed', error=traceback.format_exc(limit=3))
+        else:
+            # uploads and intermediate data are only needed to resume, drop them once the job is complete
+            self._remove_files(job_id)
+            self._update(job_id, status='complete')
+
+    def jobs(self, kind=None):
+        now = time.time()
+        with self._lock:
+            records = [dict(record) for record in self._jobs.values() if kind is None or record["kind"] == kind]
+        for record in records:
+            elapsed = (record["updated_at"] if record["status"] != 'running' else now) - (record["started_at"] or now)
+            record["throughput"] = (record["done"] - record["done_at_start"]) / elapsed if elapsed > 0 else 0
+        return sorted(records, key=lambda item: -item["created_at"])
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    # one runner per process, shared by every page and session
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+        return _runner
+
+
+def show_jobs(st, runner, kind, unit):
+    # the jobs load shared indices, so every session sees them, also after a reload or a restart
+    records = runner.jobs(kind)
+    if not records:
+        return
+    st.subheader('Jobs:')
+    for record in records:
+        label = record["params"].get("label", record["id"][:8])
+        total = record["total"]
+        progress = f"{record['done']}/{total}" if total else f"{record['done']}"
+        st.write(f"**{label}** {record['status']}, {progress} {unit}, {record['throughput']:.1f} {unit}/s")
+        if total:
+            st.progress(min(record["done"] / total, 1.0))
+        if record["error"]:
+            st.code(record["error"])
+        if record["status"] == 'failed' and st.button('Retry', key=f"retry-{record['id']}"):
+            runner.retry(record["id"])
+            st.experimental_rerun()
+    active = any(record["status"] in ACTIVE for record in records)
+    st.button('Refresh status')
+    if active and st.toggle('Refresh automatically', value=True):
+        time.sleep(POLL_SECONDS)
+        st.experimental_rerun()
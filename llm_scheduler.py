@@ -0,0 +1,180 @@
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from conversation import num_tokens
+from profiler import lazy_import
+
+# ------------------------------------------
+#        shared LLM request scheduler
+# ------------------------------------------
+
+# concurrent requests allowed against one deployment
+MAX_CONCURRENT_REQUESTS = 4
+# token budget per deployment and minute, prompt and completion together
+TOKENS_PER_MINUTE = 40000
+# completion tokens reserved for every request until the real size is known
+EXPECTED_COMPLETION_TOKENS = 500
+MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 30
+
+
+def default_retryable_errors():
+    errors = lazy_import('openai.error')
+    return (errors.RateLimitError, errors.Timeout, errors.APIError, errors.APIConnectionError,
+            errors.ServiceUnavailableError)
+
+
+def request_key(deployment, messages):
+    payload = json.dumps([deployment] + [[message.type, message.content] for message in messages])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def estimate_tokens(messages):
+    return sum(num_tokens(message.content) for message in messages) + EXPECTED_COMPLETION_TOKENS
+
+
+class LLMScheduler:
+    """Process wide dispatch of chat completions.
+
+    Identical requests that are in flight at the same time share one call. Every
+    deployment has a FIFO queue that admits a request once a concurrency slot and
+    enough of the tokens per minute budget are free. Throttling and transient API
+    errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_attempts=MAX_ATTEMPTS, max_backoff=MAX_BACKOFF_SECONDS, retryable_errors=None):
+        self.max_concurrent = max_concurrent
+        self.tokens_per_minute = tokens_per_minute
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.retryable_errors = retryable_errors
+        self._condition = threading.Condition()
+        self._in_flight = {}
+        self._deployments = {}
+        self._totals = {"requests": 0, "calls": 0, "coalesced": 0, "retries": 0, "failures": 0,
+                        "queue_wait": 0.0, "max_queue_wait": 0.0}
+
+    def _deployment(self, deployment):
+        if deployment not in self._deployments:
+            self._deployments[deployment] = {"active": 0, "queue": deque(), "window": deque()}
+        return self._deployments[deployment]
+
+    def _window_tokens(self, state, now):
+        window = state["window"]
+        while window and now - window[0][0] >= 60:
+            window.popleft()
+        return sum(entry[1] for entry in window)
+
+    def _acquire(self, deployment, tokens):
+        # wait for our turn at the head of the queue, then for a free slot and token budget
+        ticket = object()
+        start = time.perf_counter()
+        with self._condition:
+            state = self._deployment(deployment)
+            state["queue"].append(ticket)
+            while True:
+                now = time.monotonic()
+                used = self._window_tokens(state, now)
+                has_budget = not state["window"] or used + tokens <= self.tokens_per_minute
+                if state["queue"][0] is ticket and state["active"] < self.max_concurrent and has_budget:
+                    break
+                timeout = None
+                if state["queue"][0] is ticket and not has_budget:
+                    timeout = max(60 - (now - state["window"][0][0]), 0.01)
+                self._condition.wait(timeout)
+            state["queue"].popleft()
+            state["active"] += 1
+            entry = [time.monotonic(), tokens]
+            state["window"].append(entry)
+            # the next request in line may also fit
+            self._condition.notify_all()
+        return entry, time.perf_counter() - start
+
+    def _release(self, deployment):
+        with self._condition:
+            self._deployment(deployment)["active"] -= 1
+            self._condition.notify_all()
+
+    def _call(self, deployment, chat_model, messages):
+        tokens = estimate_tokens(messages)
+        prompt_tokens = tokens - EXPECTED_COMPLETION_TOKENS
+        retryable_errors = self.retryable_errors or default_retryable_errors()
+        queue_wait = 0.0
+        attempts = 0
+        retrying = Retrying(retry=retry_if_exception_type(retryable_errors),
+                            wait=wait_random_exponential(multiplier=1, max=self.max_backoff),
+                            stop=stop_after_attempt(self.max_attempts), reraise=True)
+        try:
+            for attempt in retrying:
+                with attempt:
+                    attempts += 1
+                    entry, waited = self._acquire(deployment, tokens)
+                    queue_wait += waited
+                    try:
+                        content = chat_model(messages).content
+                    finally:
+                        self._release(deployment)
+                    # charge the real completion size against the budget
+                    with self._condition:
+                        entry[1] = prompt_tokens + num_tokens(content)
+                        self._condition.notify_all()
+        except retryable_errors as error:
+            # callers show these alongside the error once every attempt is used up
+            error.llm_stats = {"queue_wait": queue_wait, "attempts": attempts, "coalesced": False}
+            raise
+        return content, {"queue_wait": queue_wait, "attempts": attempts, "coalesced": False}
+
+    def request(self, deployment, chat_model, messages):
+        """Returns the completion text and the queue wait, attempts and coalescing of this request.
+
+        Coalesced requests also report total_wait, the time spent waiting for the shared call.
+        """
+        key = request_key(deployment, messages)
+        with self._condition:
+            self._totals["requests"] += 1
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._totals["coalesced"] += 1
+        if not owner:
+            # waiters report the queue wait of the shared call, total_wait also includes the model latency
+            start = time.perf_counter()
+            content, owner_stats = future.result()
+            return content, {"queue_wait": owner_stats["queue_wait"], "attempts": 0, "coalesced": True,
+                             "total_wait": time.perf_counter() - start}
+        try:
+            content, stats = self._call(deployment, chat_model, messages)
+        except BaseException as error:
+            with self._condition:
+                self._totals["failures"] += 1
+                del self._in_flight[key]
+            future.set_exception(error)
+            raise
+        with self._condition:
+            self._totals["calls"] += 1
+            self._totals["retries"] += stats["attempts"] - 1
+            self._totals["queue_wait"] += stats["queue_wait"]
+            self._totals["max_queue_wait"] = max(self._totals["max_queue_wait"], stats["queue_wait"])
+            del self._in_flight[key]
+        future.set_result((content, stats))
+        return content, stats
+
+    def stats(self):
+        with self._condition:
+            totals = dict(self._totals)
+            totals["in_flight"] = len(self._in_flight)
+            totals["queued"] = {name: len(state["queue"]) for name, state in self._deployments.items()}
+            totals["active"] = {name: state["active"] for name, state in self._deployments.items()}
+        calls = totals["calls"] or 1
+        totals["mean_queue_wait"] = totals["queue_wait"] / calls
+        return totals
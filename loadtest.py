@@ -0,0 +1,376 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from assistants import INDICES, CAMPAIGN_INDEX, retrieve, build_prompt, campaign_prompt, get_campaigns
+from conversation import approximate_tokens, new_conversation, add_turn
+from llm_scheduler import LLMScheduler, MAX_CONCURRENT_REQUESTS, TOKENS_PER_MINUTE
+from support_index import SupportIndex
+
+# ------------------------------------------------------------------
+#        offline load test for concurrent assistant sessions
+# ------------------------------------------------------------------
+#
+# Every simulated session runs a submit on its own thread, the way Streamlit
+# runs one script thread per session. It uses the retrieval and prompts from
+# assistants.py that start.py uses, and the same filters. Support questions go
+# through the in-process support index first. The LLM is called through the
+# shared scheduler and, for transactions, campaigns are fetched. Elasticsearch
+# and the chat model are replaced by local stand-ins with configurable latency
+# and errors.
+#
+#   python loadtest.py --sessions 40 --duration 120 --llm-latency 2.5
+#
+# Tokens are estimated from word counts so the run needs no network access,
+# pass --tiktoken to count them with the real encoding instead.
+#
+# Only the errors injected by the stand-ins are counted as request errors, any
+# other exception is a broken setup and fails the run.
+
+ASSISTANT_TYPES = ('Transaction analyser', 'Customer support', 'Report analyser')
+QUESTIONS = {
+    'Transaction analyser': ['Which subscription services do i have?', 'How much do I spend on food and groceries?',
+                             'What are my favourite fashion retailers?'],
+    'Customer support': ['How do I reset my password?', 'My card was stolen, what should I do?',
+                         'What are the fees for international transfers?',
+                         'Can I change the currency of my savings account?'],
+    'Report analyser': ['How did revenue develop this year?', 'What dividend is proposed?',
+                        'Summarise the capital position.']
+}
+# the last support question has no matching article, so it always falls back to the hybrid query
+SUPPORT_ARTICLES = {
+    'How do I reset my password?': 'Reset your password',
+    'My card was stolen, what should I do?': 'What to do when your card was stolen',
+    'What are the fees for international transfers?': 'Fees for international transfers'
+}
+SUPPORT_CORPUS_SIZE = 200
+DAYS = (30, 90, 180)
+REPORT_NAMES = ('Annual report 2024', 'Annual report 2025')
+
+
+class StandInError(Exception):
+    pass
+
+
+class Message:
+    def __init__(self, type, content):
+        self.type = type
+        self.content = content
+
+
+def sample_latency(rng, mean):
+    # log normal around the mean, latencies have a long tail
+    return rng.lognormvariate(0, 0.5) * mean / 1.133 if mean > 0 else 0
+
+
+class Gauge:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+
+class FakeIndices:
+    def __init__(self, es):
+        self._es = es
+
+    def stats(self, index, metric=None):
+        self._es.wait(index)
+        count = len(self._es.corpus)
+        return {"_all": {"primaries": {"indexing": {"index_total": count}}}}
+
+
+class FakeElasticsearch:
+    """Stand in for the Elasticsearch client with a bounded connection pool.
+
+    Searches return hits in the client's response shape and fail at the error
+    rate. The support corpus can be counted and scanned, so a SupportIndex can
+    be loaded from it.
+    """
+
+    def __init__(self, latency, error_rate, connections, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._pool = threading.BoundedSemaphore(connections)
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.in_use = Gauge()
+        self.pool_waits = 0
+        self._lock = threading.Lock()
+        self.indices = FakeIndices(self)
+        self.corpus = support_corpus(seed)
+
+    def _draw(self):
+        with self._rng_lock:
+            return sample_latency(self._rng, self.latency), self._rng.random()
+
+    def wait(self, index, error_rate=0):
+        if not self._pool.acquire(blocking=False):
+            with self._lock:
+                self.pool_waits += 1
+            self._pool.acquire()
+        try:
+            with self.in_use:
+                latency, roll = self._draw()
+                time.sleep(latency)
+                if roll < error_rate:
+                    raise StandInError(f"search on {index} failed")
+        finally:
+            self._pool.release()
+
+    def search(self, index, query, size=10, fields=None):
+        self.wait(index, self.error_rate)
+        hits = fake_hits(index, query_text(query), size)
+        return {"hits": {"total": {"value": len(hits), "relation": "eq"},
+                         "hits": [{"_score": hit.pop("_score"), "_source": hit} for hit in hits]}}
+
+    def count(self, index):
+        self.wait(index)
+        return {"count": len(self.corpus)}
+
+    def scan(self, index):
+        self.wait(index)
+        return [{"_source": document} for document in self.corpus]
+
+
+def support_corpus(seed):
+    rng = random.Random(seed)
+    corpus = [{"title": title, "body_content": f"{question} {title}."} for question, title in SUPPORT_ARTICLES.items()]
+    corpus += [{"title": f"Support article {i}", "body_content": ' '.join(f"word{rng.randint(0, 500)}" for _ in range(120))}
+               for i in range(SUPPORT_CORPUS_SIZE - len(corpus))]
+    return corpus
+
+
+def query_text(query):
+    # the question is the model text of the ELSER clause, the rest of the query changes with the date filter
+    if isinstance(query, dict):
+        if "model_text" in query:
+            return query["model_text"]
+        values = query.values()
+    elif isinstance(query, list):
+        values = query
+    else:
+        return ''
+    for value in values:
+        text = query_text(value)
+        if text:
+            return text
+    return ''
+
+
+def fake_hits(index, question, size):
+    # deterministic per question, so the same question builds the same prompt in every session
+    rng = random.Random(f"{index}:{question}")
+    if index == 'search-transactions':
+        return [{"transaction_date": f"2026-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}", "value": rng.randint(0, 150),
+                 "description": f"Purchase number {i} at a retailer", "_score": rng.uniform(1, 20)} for i in range(size)]
+    if index == 'search-annual-reports':
+        return [{"page": rng.randint(1, 40), "section": rng.randint(1, 4), "import_mode": rng.choice(('reliable', 'experimental')),
+                 "text": ' '.join(f"word{rng.randint(0, 500)}" for _ in range(180)), "_score": rng.uniform(5, 20)}
+                for _ in range(size)]
+    if index == 'search-campaigns':
+        return [{"campaign_name": "Cashback", "campaign_description": "Five percent back on groceries", "_score": 9}]
+    return [{"title": f"Support article {i}", "body_content": ' '.join(f"word{rng.randint(0, 500)}" for _ in range(120)),
+             "_score": rng.uniform(1, 20)} for i in range(size)]
+
+
+class FakeChatModel:
+    """Stand in for the chat model, raises StandInError to simulate throttling."""
+
+    def __init__(self, latency, error_rate, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.in_flight = Gauge()
+        self.calls = 0
+
+    def __call__(self, messages):
+        with self._rng_lock:
+            latency, roll = sample_latency(self._rng, self.latency), self._rng.random()
+            self.calls += 1
+        with self.in_flight:
+            time.sleep(latency)
+        if roll < self.error_rate:
+            raise StandInError("429 too many requests")
+        return Message('ai', f"Answer to: {messages[-1].content[-80:]}")
+
+
+def to_messages(prompt):
+    return [Message(role, content) for role, content in prompt]
+
+
+def run_submit(es, support_index, scheduler, chat_model, conversation, assistant_type, question, days, report_name,
+               opt_in):
+    results, _ = retrieve(es, support_index, conversation, assistant_type, question, days=days,
+                          report_name=report_name)
+    answer, stats = scheduler.request('load-test', chat_model,
+                                      to_messages(build_prompt(conversation, assistant_type, question, results)))
+    add_turn(conversation, question, answer)
+    if assistant_type == 'Transaction analyser':
+        # start.py looks up campaigns for every transaction question, and only asks the LLM about them on opt in
+        campaigns = get_campaigns(es, CAMPAIGN_INDEX, json.dumps(results))
+        if campaigns and opt_in:
+            scheduler.request('load-test', chat_model, to_messages(campaign_prompt(campaigns)))
+    return stats["queue_wait"]
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def run_load_test(sessions=20, duration=60, think_time=5.0, ramp_up=10.0, es_latency=0.15, es_error_rate=0.01,
+                  es_connections=10, llm_latency=2.0, llm_error_rate=0.05, llm_concurrency=MAX_CONCURRENT_REQUESTS,
+                  tokens_per_minute=TOKENS_PER_MINUTE, follow_up_rate=0.3, opt_in_rate=0.3, support_hot_index=True,
+                  seed=1):
+    es = FakeElasticsearch(es_latency, es_error_rate, es_connections, seed)
+    support_index = None
+    if support_hot_index:
+        support_index = SupportIndex(es, INDICES['Customer support'], scan=lambda client, index: client.scan(index))
+    chat_model = FakeChatModel(llm_latency, llm_error_rate, seed)
+    scheduler = LLMScheduler(max_concurrent=llm_concurrency, tokens_per_minute=tokens_per_minute,
+                             retryable_errors=(StandInError,))
+    lock = threading.Lock()
+    latencies = {assistant_type: [] for assistant_type in ASSISTANT_TYPES}
+    queue_waits = []
+    errors = {}
+    failures = []
+    peak_threads = [threading.active_count()]
+    deadline = time.monotonic() + duration
+    stop = threading.Event()
+    abort = threading.Event()
+
+    def session(number):
+        rng = random.Random(seed * 1000 + number)
+        time.sleep(rng.uniform(0, ramp_up))
+        conversation = new_conversation()
+        assistant_type = rng.choice(ASSISTANT_TYPES)
+        days, report_name = rng.choice(DAYS), rng.choice(REPORT_NAMES)
+        while time.monotonic() < deadline and not abort.is_set():
+            if rng.random() >= follow_up_rate:
+                # a new topic, as if the user changed the assistant type or the filters
+                assistant_type = rng.choice(ASSISTANT_TYPES)
+                days, report_name = rng.choice(DAYS), rng.choice(REPORT_NAMES)
+                conversation = new_conversation()
+            question = rng.choice(QUESTIONS[assistant_type])
+            start = time.perf_counter()
+            try:
+                queue_wait = run_submit(es, support_index, scheduler, chat_model, conversation, assistant_type,
+                                        question, days, report_name, rng.random() < opt_in_rate)
+            except StandInError as error:
+                with lock:
+                    errors[str(error)] = errors.get(str(error), 0) + 1
+            except BaseException as error:
+                failures.append(error)
+                abort.set()
+                return
+            else:
+                with lock:
+                    latencies[assistant_type].append(time.perf_counter() - start)
+                    queue_waits.append(queue_wait)
+            abort.wait(rng.expovariate(1 / think_time) if think_time > 0 else 0)
+
+    def monitor():
+        while not stop.wait(0.1):
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+    monitor_thread = threading.Thread(target=monitor, daemon=True)
+    monitor_thread.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(number,), daemon=True) for number in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    monitor_thread.join()
+    if failures:
+        raise failures[0]
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    report = {
+        "sessions": sessions,
+        "elapsed_seconds": round(elapsed, 2),
+        "requests": len(all_latencies),
+        "errors": errors,
+        "throughput_per_second": round(len(all_latencies) / elapsed, 3),
+        "latency": {},
+        "queue_wait_p95": round(percentile(queue_waits, 0.95), 3),
+        "peak_threads": peak_threads[0],
+        "peak_es_connections": es.in_use.peak,
+        "es_pool_waits": es.pool_waits,
+        "peak_llm_in_flight": chat_model.in_flight.peak,
+        "llm_calls": chat_model.calls,
+        "support_index": dict(support_index.stats) if support_index else None,
+        "scheduler": scheduler.stats()
+    }
+    for name, values in [('all', all_latencies)] + list(latencies.items()):
+        report["latency"][name] = {"count": len(values), "p50": round(percentile(values, 0.5), 3),
+                                   "p95": round(percentile(values, 0.95), 3), "p99": round(percentile(values, 0.99), 3)}
+    return report
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions, {report['requests']} requests in {report['elapsed_seconds']}s "
+          f"({report['throughput_per_second']} req/s), errors: {report['errors'] or 'none'}")
+    print(f"{'assistant':<22}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, values in report["latency"].items():
+        print(f"{name:<22}{values['count']:>7}{values['p50']:>9}{values['p95']:>9}{values['p99']:>9}")
+    scheduler = report["scheduler"]
+    print(f"peak threads: {report['peak_threads']}, peak es connections: {report['peak_es_connections']} "
+          f"(pool waits: {report['es_pool_waits']}), peak llm in flight: {report['peak_llm_in_flight']}")
+    print(f"llm calls: {report['llm_calls']}, coalesced: {scheduler['coalesced']}, retries: {scheduler['retries']}, "
+          f"queue wait p95: {report['queue_wait_p95']}s, max: {round(scheduler['max_queue_wait'], 3)}s")
+    if report["support_index"]:
+        support = report["support_index"]
+        print(f"support index: {support['local']} answered locally, {support['fallback']} fell back, "
+              f"{support['loads']} loads")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate concurrent assistant sessions against local stand-ins.')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=60, help='seconds sessions keep submitting questions')
+    parser.add_argument('--think-time', type=float, default=5.0, help='mean seconds between submits of a session')
+    parser.add_argument('--ramp-up', type=float, default=10.0)
+    parser.add_argument('--es-latency', type=float, default=0.15)
+    parser.add_argument('--es-error-rate', type=float, default=0.01)
+    parser.add_argument('--es-connections', type=int, default=10)
+    parser.add_argument('--llm-latency', type=float, default=2.0)
+    parser.add_argument('--llm-error-rate', type=float, default=0.05)
+    parser.add_argument('--llm-concurrency', type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--tokens-per-minute', type=int, default=TOKENS_PER_MINUTE)
+    parser.add_argument('--follow-up-rate', type=float, default=0.3)
+    parser.add_argument('--opt-in-rate', type=float, default=0.3)
+    parser.add_argument('--no-support-hot-index', dest='support_hot_index', action='store_false',
+                        help='send every support question to the hybrid query')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tiktoken', action='store_true', help='count tokens with tiktoken, needs the encoding')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = vars(parser.parse_args())
+    as_json = args.pop('json')
+    if not args.pop('tiktoken'):
+        approximate_tokens()
+    result = run_load_test(**args)
+    if as_json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    if not result["requests"]:
+        sys.exit('no request succeeded')
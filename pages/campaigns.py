@@ -1,3 +1,7 @@
+from profiler import start_page, mark_first_paint, show_report
+
+start_page('campaigns')
+
 import streamlit as st
 import os
 from elasticsearch import Elasticsearch, helpers
@@ -53,5 +57,9 @@ with st.form("campaign-form"):
         }
         response = es.index(index='search-campaigns', id=doc_id, document=doc, pipeline="search-campaigns")
 
+mark_first_paint('campaigns')
+
 campaign_list = get_campaigns('search-campaigns')
 st.dataframe(campaign_list)
+
+show_report(st)
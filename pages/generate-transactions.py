@@ -3,14 +3,18 @@
 #       import all dependencies
 # ------------------------------------------
 
+from profiler import start_page, mark_first_paint, show_report
+
+start_page('generate-transactions')
+
 import os
-import tqdm
+import json
+import math
 import streamlit as st
-import pandas as pd
-import numpy as np
 import random
 from datetime import datetime, timedelta
 from elasticsearch import Elasticsearch, helpers
+from jobs import get_runner, show_jobs
 
 os.environ['elastic_cloud_id'] = st.secrets['cloud_id']
 os.environ['elastic_user'] = st.secrets['user']
@@ -113,23 +117,10 @@ def get_random_transaction_type():
     transaction_type = ' '.join(transaction_type)
     return transaction_type
 
-# ------------------------------------------
-#       this is the logic block
-# ------------------------------------------
-
-st.title('Data generation for banking demo')
-columns = ['transaction_date', 'value','balance','account_number', 'description', 'entity', 'transaction_type']
-
-with st.form("setup_form"):
-    number_of_months = st.number_input('Enter the number of months to generate data for:', min_value=1, max_value=10, value=3,step=1)
-    st.text("Provide the range of transactions per day:")
-    start_int = st.number_input('From:', min_value=1, max_value=10, value=3,step=1)
-    end_int = st.number_input('To:', min_value=1, max_value=10, value=3,step=1)
-    submit = st.form_submit_button('Generate data')
-
-if submit:
+# generate the transactions for the requested number of months
+def generate_transactions(number_of_months, start_int, end_int):
     total_days = number_of_months*30
-    df = pd.DataFrame(columns=columns)
+    records = []
 
     counter = 0
     while counter <= total_days:
@@ -169,35 +160,77 @@ if submit:
                     'entity': entity,
                     'transaction_type': transaction_type
                 }
-            df.loc[len(df)] = new_row    
+            records.append(new_row)
             transaction_count = transaction_count + 1
         counter = counter + 1
-        
-    
-    st.dataframe(df, use_container_width=True)
-    index_name = "search-transactions"
-    # clear any existing data
-    delete_response = delete_by_query(index_name)
-    # convert dataframe to dict
-    data = df.to_dict(orient='records')
-
-    actions = [
-        {
-            '_index': index_name,
-            '_id': i,
-            '_source': doc
-        }
-        for i, doc in enumerate(data)
-    ]
-    number_of_docs = len(actions)
-    progress = tqdm.tqdm(unit="docs", total=number_of_docs)
-    successes = 0
-    for ok, action in helpers.streaming_bulk(
-        client=es, index=index_name, actions=actions, initial_backoff=5, max_backoff=30, chunk_size=50,
-    ):
-        progress.update(1)
-        successes += ok
-    
-    st.balloons()
-    st.write("Indexed %d/%d documents" % (successes, number_of_docs))
-    
\ No newline at end of file
+    return records
+
+# generate the data once, then bulk load it chunk by chunk so an interrupted load resumes
+def load_transactions(job):
+    params = job.params
+    index_name = params["index_name"]
+    data_path = job.path('transactions.json')
+    if 'chunk' not in job.checkpoint:
+        data = generate_transactions(params["number_of_months"], params["start_int"], params["end_int"])
+        with open(data_path, 'w') as data_file:
+            json.dump(data, data_file)
+        # clear any existing data
+        delete_response = delete_by_query(index_name)
+        job.save_checkpoint(0, chunk=0)
+    else:
+        with open(data_path) as data_file:
+            data = json.load(data_file)
+    number_of_docs = len(data)
+    job.set_total(number_of_docs)
+    chunk_size = params["chunk_size"]
+    for chunk in range(job.checkpoint["chunk"], math.ceil(number_of_docs / chunk_size)):
+        first_doc = chunk * chunk_size
+        actions = [
+            {
+                '_index': index_name,
+                '_id': i,
+                '_source': data[i]
+            }
+            for i in range(first_doc, min(first_doc + chunk_size, number_of_docs))
+        ]
+        helpers.bulk(client=es, actions=actions, initial_backoff=5, max_backoff=30, chunk_size=chunk_size)
+        job.save_checkpoint(first_doc + len(actions), chunk=chunk + 1)
+
+
+runner = get_runner()
+runner.register('transaction-load', load_transactions)
+
+# ------------------------------------------
+#       this is the logic block
+# ------------------------------------------
+
+st.title('Data generation for banking demo')
+
+with st.form("setup_form"):
+    number_of_months = st.number_input('Enter the number of months to generate data for:', min_value=1, max_value=10, value=3,step=1)
+    st.text("Provide the range of transactions per day:")
+    start_int = st.number_input('From:', min_value=1, max_value=10, value=3,step=1)
+    end_int = st.number_input('To:', min_value=1, max_value=10, value=3,step=1)
+    submit = st.form_submit_button('Generate data')
+mark_first_paint('generate-transactions')
+
+if submit:
+    # generation and loading run in the background and survive reruns and navigation
+    params = {
+        "label": f"{number_of_months} months, {start_int}-{end_int} transactions per day",
+        "number_of_months": number_of_months,
+        "start_int": start_int,
+        "end_int": end_int,
+        "index_name": "search-transactions",
+        "chunk_size": 50
+    }
+    runner.submit('transaction-load', params)
+    st.write("Data generation started, you can leave this page while it runs.")
+
+completed = [job for job in runner.jobs('transaction-load') if job["status"] == 'complete']
+if completed:
+    st.write("Indexed %d documents in the latest run" % completed[0]["done"])
+
+show_report(st)
+
+show_jobs(st, runner, 'transaction-load', 'docs')
@@ -1,14 +1,14 @@
+from profiler import lazy_import, start_page, mark_first_paint, show_report
+
+start_page('uploader')
+
 import os
-import tqdm
 import streamlit as st
-from elasticsearch import Elasticsearch, helpers
-from PyPDF2 import PdfReader
-import PyPDF2
-import nltk
-from nltk.tokenize import sent_tokenize
+from elasticsearch import Elasticsearch
 import math
 import uuid
 import re
+from jobs import get_runner, show_jobs
 
 os.environ['elastic_cloud_id'] = st.secrets['cloud_id']
 os.environ['elastic_user'] = st.secrets['user']
@@ -23,7 +23,7 @@ def split_doc_sections(text, max_length=1024):
     sections = []
     current_section = ""
     current_length = 0
-    sentences = sent_tokenize(text)
+    sentences = lazy_import('nltk.tokenize').sent_tokenize(text)
     for sentence in sentences:
         if current_length + len(sentence) <= max_length:
             current_section += sentence + ' '
@@ -37,14 +37,74 @@ def split_doc_sections(text, max_length=1024):
     return sections
 
 
+def split_word_sections(text):
+    words = text.split()
+    total_words = len(words)
+    if total_words == 0:
+        return []
+    doc_sections = math.ceil(total_words / 256)
+    words_per_section = total_words // doc_sections
+
+    sections = []
+    start_index = 0
+
+    for _ in range(doc_sections - 1):
+        end_index = start_index + words_per_section
+        section = " ".join(words[start_index:end_index])
+        sections.append(section)
+        start_index = end_index
+
+    final_section = " ".join(words[start_index:])
+    sections.append(final_section)
+    return sections
+
+
+def import_report(job):
+    params = job.params
+    reader = lazy_import('PyPDF2').PdfReader(job.path('report.pdf'))
+    number_of_pages = len(reader.pages)
+    job.set_total(number_of_pages)
+    if params["mode"] == 'experimental':
+        lazy_import('nltk').download('punkt', quiet=True)
+    # resume after the last page that was fully indexed
+    for page_index in range(job.checkpoint.get('page', 0), number_of_pages):
+        page_text = reader.pages[page_index].extract_text()
+        if params["mode"] == 'experimental':
+            sections = [re.sub(r'\s+', ' ', section.strip()) for section in split_doc_sections(page_text)]
+        else:
+            sections = split_word_sections(page_text)
+        # both import modes number pages from 1
+        page_number = page_index + 1
+        for i, section in enumerate(sections):
+            # stable ids, so a page that is indexed again after an interruption is overwritten
+            doc_id = uuid.uuid5(uuid.NAMESPACE_URL, f"{params['report_name']}/{params['mode']}/{page_number}/{i + 1}")
+            doc = {
+                "report_name": params["report_name"],
+                "text": section,
+                "publish_date": params["publish_date"],
+                "page": page_number,
+                "section": i + 1,
+                "import_mode": params["mode"],
+                "_extract_binary_content": True,
+                "_reduce_whitespace": True,
+                "_run_ml_inference": True
+            }
+            es.index(index='search-annual-reports', id=doc_id, document=doc, pipeline="search-annual-reports")
+        job.save_checkpoint(page_index + 1, page=page_index + 1)
+
+
+runner = get_runner()
+runner.register('report-import', import_report)
 
 # ---------------------------------------------
 #           PDF uploader
 # ---------------------------------------------
 st.title('Annual report uploader')
 uploaded_file = st.file_uploader("Choose a file:")
+mark_first_paint('uploader')
 if uploaded_file is not None:
-    reader = PdfReader(uploaded_file)
+    PyPDF2 = lazy_import('PyPDF2')
+    reader = PyPDF2.PdfReader(uploaded_file)
     number_of_pages = len(reader.pages)
     st.write(f"number of pages: {number_of_pages}")
     report_name = st.text_input("What is the name of the annual report?")
@@ -52,75 +112,18 @@ if uploaded_file is not None:
     if report_name is not None:
         import_text = st.button("Import (reliable)?")
         import_doc = st.button("Import (experimental)?")
-        if import_doc:
-            pdf_reader = PyPDF2.PdfReader(uploaded_file)
-            nltk.download('punkt')
-            # Iterate through each page of the PDF
-            page_num = 0
-            with st.status("Uploading document") as status:
-                while page_num <= len(reader.pages):
-                    page = reader.pages[page_num]
-                    page_text = page.extract_text()
-                    # Split the page into sections
-                    sections = split_doc_sections(page_text)
-                    # Output the sections
-                    for i, section in enumerate(sections):
-                        trimmed_text = section.strip()
-                        trimmed_text = re.sub(r'\s+', ' ', trimmed_text)
-                        doc_id = uuid.uuid4()
-                        doc = {
-                            "report_name": report_name,
-                            "text": trimmed_text,
-                            "publish_date": publish_date,
-                            "page": page_num,
-                            "section": i + 1,
-                            "_extract_binary_content": True,
-                            "_reduce_whitespace": True,
-                            "_run_ml_inference": True
-                        }
-                        response = es.index(index='search-annual-reports', id=doc_id, document=doc, pipeline="search-annual-reports")
-                        st.write(f"Page: {page_num}, Section: {i + 1}")
-                    page_num = page_num + 1
-            status.update(label="Upload complete!", state="complete")
-        if import_text:
-            counter = 0
-            with st.status("Uploading document") as status:
-                while counter < number_of_pages:
-                    selected_page = counter
-                    if selected_page is not None:
-                        page = reader.pages[selected_page]
-                        text = page.extract_text()
-                        words = text.split()
-                        sentences = text.split(". ")
-                        total_words = len(words)
-                        doc_sections = math.ceil(total_words / 256)
-                        words_per_section = total_words // doc_sections
-
-                        sections = []
-                        start_index = 0
-
-                        for _ in range(doc_sections - 1):
-                            end_index = start_index + words_per_section
-                            section = " ".join(words[start_index:end_index])
-                            sections.append(section)
-                            start_index = end_index
-
-                        final_section = " ".join(words[start_index:])
-                        sections.append(final_section)
-                        for i, section in enumerate(sections):
-                            st.write(f"Page number: {selected_page + 1}")
-                            # st.write(text)
-                            doc_id = uuid.uuid4()
-                            doc = {
-                                "report_name": report_name,
-                                "text": section,
-                                "publish_date": publish_date,
-                                "page": selected_page + 1,
-                                "_extract_binary_content": True,
-                                "_reduce_whitespace": True,
-                                "_run_ml_inference": True
-                            }
-                            response = es.index(index='search-annual-reports', id=doc_id, document=doc,
-                                                pipeline="search-annual-reports")
-                    counter = counter + 1
-            status.update(label="Upload complete!", state="complete")
+        if import_text or import_doc:
+            # the import runs in the background and survives reruns and navigation
+            mode = 'experimental' if import_doc else 'reliable'
+            params = {
+                "label": f"{report_name} ({mode})",
+                "report_name": report_name,
+                "publish_date": publish_date.isoformat(),
+                "mode": mode
+            }
+            runner.submit('report-import', params, files={'report.pdf': uploaded_file.getvalue()})
+            st.write("Upload started, you can leave this page while it runs.")
+
+show_report(st)
+
+show_jobs(st, runner, 'report-import', 'pages')
@@ -0,0 +1,105 @@
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+# ------------------------------------------
+#        startup profiler
+# ------------------------------------------
+
+# set STARTUP_PROFILE=1 to show the timings in the sidebar of every page
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE') == '1'
+
+# heavy dependencies loaded by each page, used when profiling from the command line
+PAGE_DEPENDENCIES = {
+    "start": ['elasticsearch', 'tiktoken', 'pandas', 'langchain.schema', 'langchain.chat_models'],
+    "uploader": ['elasticsearch', 'PyPDF2', 'nltk.tokenize'],
+    "generate-transactions": ['elasticsearch'],
+    "campaigns": ['elasticsearch']
+}
+
+process_start = time.perf_counter()
+# time from the profiler's import to the first paint of the first page run in this process
+process_first_paint = {}
+import_times = {}
+first_paint = {}
+last_paint = {}
+run_start = {}
+
+
+def lazy_import(name):
+    # import a module on the code path that needs it and record how long the first import took
+    if name in sys.modules:
+        # import_module waits for a module another thread is still initialising
+        return importlib.import_module(name)
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times[name] = time.perf_counter() - start
+    return module
+
+
+def start_page(page):
+    run_start[page] = time.perf_counter()
+
+
+def mark_first_paint(page):
+    now = time.perf_counter()
+    last_paint[page] = now - run_start.get(page, now)
+    if page not in first_paint:
+        # the first run of a page in this process is its cold start
+        first_paint[page] = last_paint[page]
+    if not process_first_paint:
+        process_first_paint[page] = now - process_start
+
+
+def report():
+    return {
+        "imports": [{"module": name, "seconds": round(seconds, 3)}
+                    for name, seconds in sorted(import_times.items(), key=lambda item: -item[1])],
+        "first_paint": [{"page": page, "cold_seconds": round(first_paint[page], 3),
+                         "last_run_seconds": round(last_paint.get(page, 0), 3)} for page in first_paint],
+        "process_first_paint": [{"page": page, "seconds": round(seconds, 3)}
+                                for page, seconds in process_first_paint.items()]
+    }
+
+
+def show_report(st):
+    if not STARTUP_PROFILE:
+        return
+    data = report()
+    with st.sidebar.expander('Startup profile'):
+        st.write('Time to first paint:')
+        st.dataframe(data["first_paint"])
+        st.write('Process start to first paint:')
+        st.dataframe(data["process_first_paint"])
+        st.write('Lazy imports:')
+        st.dataframe(data["imports"])
+
+
+def measure_cold_imports(modules):
+    # import each module in a fresh interpreter and parse the cumulative time from -X importtime
+    timings = {}
+    for name in modules:
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {name}'],
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            timings[name] = None
+            continue
+        for line in completed.stderr.splitlines():
+            parts = [part.strip() for part in line.split('|')]
+            if len(parts) == 3 and parts[2] == name:
+                timings[name] = int(parts[1]) / 1000000
+    return timings
+
+
+if __name__ == '__main__':
+    pages = sys.argv[1:] or list(PAGE_DEPENDENCIES)
+    for page in pages:
+        print(f"{page}:")
+        timings = measure_cold_imports(PAGE_DEPENDENCIES[page])
+        for name, seconds in sorted(timings.items(), key=lambda item: -(item[1] or 0)):
+            if seconds is None:
+                print(f"  {name:<25} not installed")
+            else:
+                print(f"  {name:<25} {seconds:.3f}s")
@@ -0,0 +1,121 @@
+import random
+import re
+import zlib
+
+# ------------------------------------------
+#        report context assembly
+# ------------------------------------------
+
+SHINGLE_WORDS = 5
+NUM_HASHES = 64
+# share of the smaller section's shingles found in the other one to count as a duplicate
+DUPLICATE_CONTAINMENT = 0.8
+_PRIME = (1 << 61) - 1
+_random = random.Random(42)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_HASHES)]
+
+
+def normalise(words):
+    return [re.sub(r"\W+", '', word.lower()) for word in words]
+
+
+def shingle_list(words):
+    # one shingle per starting word, so shingle i covers words i to i + SHINGLE_WORDS - 1
+    if len(words) <= SHINGLE_WORDS:
+        return [' '.join(words)]
+    return [' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+
+
+def shingles(text):
+    return set(shingle_list(normalise(text.split())))
+
+
+def minhash(shingle_set):
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def containment(first, second):
+    # estimate the jaccard similarity from the signatures, then how much of the smaller set is shared
+    jaccard = sum(1 for x, y in zip(first["signature"], second["signature"]) if x == y) / NUM_HASHES
+    intersection = jaccard / (1 + jaccard) * (first["size"] + second["size"])
+    return intersection / min(first["size"], second["size"])
+
+
+def collapse_duplicates(sections):
+    # the two uploader modes index the same text twice, keep the longest copy with the best score
+    kept = []
+    for section in sorted(sections, key=lambda item: -len(item.get('text', ''))):
+        shingle_set = shingles(section.get('text', ''))
+        candidate = {"section": dict(section), "signature": minhash(shingle_set), "size": len(shingle_set)}
+        for existing in kept:
+            if containment(candidate, existing) >= DUPLICATE_CONTAINMENT:
+                existing["section"]["_score"] = max(existing["section"]["_score"], section["_score"])
+                break
+        else:
+            kept.append(candidate)
+    return [item["section"] for item in kept]
+
+
+def trim_overlaps(sections):
+    # sections that only partly overlap a better scoring one keep just the words nobody else covers
+    seen = set()
+    trimmed = []
+    for section in sorted(sections, key=lambda item: -item["_score"]):
+        words = section.get('text', '').split()
+        section_shingles = shingle_list(normalise(words))
+        covered = [False] * len(words)
+        for start, shingle in enumerate(section_shingles):
+            if shingle in seen:
+                for index in range(start, min(start + SHINGLE_WORDS, len(words))):
+                    covered[index] = True
+        seen.update(section_shingles)
+        novel = [word if not is_covered else None for word, is_covered in zip(words, covered)]
+        if sum(1 for word in novel if word is not None) < SHINGLE_WORDS:
+            continue
+        runs = ' '.join(word if word is not None else '\0' for word in novel).split('\0')
+        section = dict(section)
+        text = ' ... '.join(run.strip() for run in runs if run.strip())
+        # mark where text was cut, so merged neighbours do not read as continuous
+        if novel[0] is None:
+            text = '... ' + text
+        if novel[-1] is None:
+            text += ' ...'
+        section['text'] = text
+        trimmed.append(section)
+    return trimmed
+
+
+def merge_page_sections(sections):
+    # sections are numbered per import mode, so only sections of the same page and mode are neighbours
+    pages = {}
+    for section in sections:
+        pages.setdefault((section.get('page'), section.get('import_mode')), []).append(section)
+    passages = []
+    for (page, _), page_sections in pages.items():
+        # sections without a number have no known neighbours, they stay separate passages in retrieval order
+        page_sections.sort(key=lambda item: (item.get('section') is None, item.get('section') or 0))
+        current = None
+        for section in page_sections:
+            number = section.get('section')
+            adjacent = (current is not None and number is not None and current["sections"][-1] is not None
+                        and number == current["sections"][-1] + 1)
+            if adjacent:
+                current["text"] += ' ' + section['text']
+                current["sections"].append(number)
+                current["_score"] = max(current["_score"], section["_score"])
+            else:
+                current = {"page": page, "sections": [number], "text": section['text'], "_score": section["_score"]}
+                passages.append(current)
+    return passages
+
+
+def assemble_passages(sections):
+    """Collapses near duplicate sections and merges neighbouring sections of a page, ordered by page."""
+    passages = merge_page_sections(trim_overlaps(collapse_duplicates(sections)))
+    passages.sort(key=lambda item: (item["page"] is None, item["page"] or 0, item["sections"][0] or 0))
+    for passage in passages:
+        passage["_score"] = round(passage["_score"], 3)
+        if all(number is None for number in passage["sections"]):
+            del passage["sections"]
+    return passages
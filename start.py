@@ -1,21 +1,16 @@
+from profiler import lazy_import, start_page, mark_first_paint, show_report
+
+start_page('start')
+
 import math
 
-import pandas as pd
 import streamlit as st
 import os
-import openai
-from elasticsearch import Elasticsearch
-from langchain.embeddings import ElasticsearchEmbeddings
-from langchain.chat_models import AzureChatOpenAI
-from langchain.schema import (
-    SystemMessage,
-    HumanMessage,
-    AIMessage
-)
-import tiktoken
 import json
-from datetime import datetime, timedelta
-from PIL import Image
+from conversation import num_tokens, get_conversation, reset_conversation, add_turn
+from llm_scheduler import LLMScheduler, default_retryable_errors
+from support_index import SupportIndex
+from assistants import INDICES, CAMPAIGN_INDEX, retrieve, build_prompt, campaign_prompt, get_campaigns
 
 # ------------------------------------------
 #        connect to elasticsearch
@@ -31,166 +26,69 @@ os.environ['elastic_password'] = st.secrets['password']
 BASE_URL = os.environ['openai_api_base']
 API_KEY = os.environ['openai_api_key']
 DEPLOYMENT_NAME = "timb-fsi-demo"
-chat_model = AzureChatOpenAI(
-    openai_api_base=BASE_URL,
-    openai_api_version=os.environ['openai_api_version'],
-    deployment_name=DEPLOYMENT_NAME,
-    openai_api_key=API_KEY,
-    openai_api_type="azure",
-    temperature=0.1
-)
-
-es = Elasticsearch(
-    cloud_id=os.environ['elastic_cloud_id'],
-    basic_auth=(os.environ['elastic_user'], os.environ['elastic_password'])
-)
-
-# Instantiate ElasticsearchEmbeddings using credentials
-model_id = ".elser_model_1"
-embeddings = ElasticsearchEmbeddings.from_es_connection(model_id, es)
-
-
-def report_analyser_search_operation(index, question, report_name):
-    model_id = ".elser_model_1"
-    query = {
-        "bool": {
-            "should": [
-                {
-                    "text_expansion": {
-                        "ml.inference.text_expanded.predicted_value": {
-                            "model_id": model_id,
-                            "model_text": question
-                        }
-                    }
-                },
-                {
-                    "match": {
-                        "text": question
-                    }
-                }
-            ],
-            "filter": {
-                "term": {
-                    "report_name": report_name
-                }
-            }
-        }
-    }
+# answer common customer support questions from an in-process index before querying Elasticsearch
+SUPPORT_HOT_INDEX = st.secrets.get('support_hot_index', True)
+
+
+# the clients and the logo are built once per process, and only when a code path needs them
+@st.cache_resource
+def get_chat_model():
+    chat_models = lazy_import('langchain.chat_models')
+    return chat_models.AzureChatOpenAI(
+        openai_api_base=BASE_URL,
+        openai_api_version=os.environ['openai_api_version'],
+        deployment_name=DEPLOYMENT_NAME,
+        openai_api_key=API_KEY,
+        openai_api_type="azure",
+        temperature=0.1,
+        # retries and backoff are handled by the shared scheduler
+        max_retries=0
+    )
+
+
+@st.cache_resource
+def get_llm_scheduler():
+    return LLMScheduler()
 
-    field_list = ['page', 'text', '_score']
-    results = es.search(index=index, query=query, size=20, fields=field_list)
-    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in results["hits"]["hits"]]
-    documents = []
-    # Check if there are hits
-    if "hits" in results and "total" in results["hits"]:
-        total_hits = results["hits"]["total"]
-        # Check if there are any hits with a value greater than 0
-        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
-            for hit in response_data:
-                if hit['_score'] > 5:
-                    doc_data = {field: hit[field] for field in field_list if field in hit}
-                    documents.append(doc_data)
-    return documents
-
-
-def customer_support_search_operation(index, question):
-    expansion_query = {
-        "bool": {
-            "should": [
-                {
-                    "text_expansion": {
-                        "ml.inference.body_content_expanded.predicted_value": {
-                            "model_id": model_id,
-                            "model_text": question
-                        }
-                    }
-                },
-                {
-                    "match": {
-                        "body_content": question
-                    }
-                }
-            ]
-        }
-    }
-    field_list = ['title', 'body_content', '_score']
-    results = es.search(index=index, query=expansion_query, size=20, fields=field_list)
-    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in results["hits"]["hits"]]
-    documents = []
-    # Check if there are hits
-    if "hits" in results and "total" in results["hits"]:
-        total_hits = results["hits"]["total"]
-
-        # Check if there are any hits with a value greater than 0
-        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
-            for hit in response_data:
-                if hit['_score'] > 0:
-                    doc_data = {field: hit[field] for field in field_list if field in hit}
-                    documents.append(doc_data)
-    return documents
-
-
-def transaction_search_operation(index, question, days):
-    set_range_date = datetime.now() - timedelta(days=days)
-    model_id = ".elser_model_1"
-    query = {
-        "bool": {
-            "should": [
-                {
-                    "text_expansion": {
-                        "ml.inference.description_expanded.predicted_value": {
-                            "model_id": model_id,
-                            "model_text": question
-                        }
-                    }
-                },
-                {
-                    "match": {
-                        "description": question
-                    }
-                }
-            ],
-            "filter": [
-                {
-                    "range": {
-                        "transaction_date": {
-                            "gte": set_range_date
-                        }
-                    }
-                }
-            ]
-        }
-    }
-    field_list = ['transaction_date', 'account_number', 'balance', 'description', 'transaction_type', 'value', 'entity',
-                  '_score']
-    results = es.search(index=index, query=query, size=100, fields=field_list)
 
+def ask_llm(messages):
+    return get_llm_scheduler().request(DEPLOYMENT_NAME, get_chat_model(), messages)
 
-    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in results["hits"]["hits"]]
-    documents = []
-    # Check if there are hits
-    if "hits" in results and "total" in results["hits"]:
-        total_hits = results["hits"]["total"]
 
-        # Check if there are any hits with a value greater than 0
-        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
-            for hit in response_data:
-                if hit['_score'] > 0:
-                    doc_data = {field: hit[field] for field in field_list if field in hit}
-                    documents.append(doc_data)
-    return documents
+def llm_error_message(error, llm_stats):
+    return (f"The AI service did not respond after {llm_stats['attempts']} attempts "
+            f"({llm_stats['queue_wait']:.2f}s in the LLM queue): {error}")
+
+
+@st.cache_resource
+def get_es():
+    elasticsearch = lazy_import('elasticsearch')
+    return elasticsearch.Elasticsearch(
+        cloud_id=os.environ['elastic_cloud_id'],
+        basic_auth=(os.environ['elastic_user'], os.environ['elastic_password'])
+    )
+
+
+@st.cache_resource
+def get_support_index(index):
+    return SupportIndex(get_es(), index)
+
+
+@st.cache_resource
+def load_logo():
+    with open('images/logo.png', 'rb') as logo:
+        return logo.read()
 
 
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return num_tokens(string, encoding_name)
 
 
-def truncate_text(text, max_tokens):
-    tokens = text.split()
-    return ' '.join(tokens[:max_tokens])
+def chat_messages(prompt):
+    schema = lazy_import('langchain.schema')
+    message_types = {'system': schema.SystemMessage, 'human': schema.HumanMessage, 'ai': schema.AIMessage}
+    return [message_types[role](content=content) for role, content in prompt]
 
 
 def set_assistant_type():
@@ -215,7 +113,7 @@ def get_reports(index):
             }
         }
     }
-    reports = es.search(index=index, body=aggregation_query)
+    reports = get_es().search(index=index, body=aggregation_query)
     buckets = reports['aggregations']['reports']['buckets']
     report_list = []
     for bucket in buckets:
@@ -224,59 +122,6 @@ def get_reports(index):
     return report_list
 
 
-def get_campaigns(index, text):
-    expansion_query = {
-        "bool": {
-            "should": [
-                {
-                    "text_expansion": {
-                        "ml.inference.campaign_description_expanded.predicted_value": {
-                            "model_id": model_id,
-                            "model_text": text
-                        }
-                    },
-                    "text_expansion": {
-                        "ml.inference.campaign_name_expanded.predicted_value": {
-                            "model_id": model_id,
-                            "model_text": text
-                        }
-                    }
-                },
-                {
-                    "match": {
-                        "campaign_description": {
-                            "query": text,
-                            "boost": 1
-                        }
-                    },
-                    "match": {
-                        "campaign_name": {
-                            "query": text,
-                            "boost": 1
-                        }
-                    }
-                }
-            ]
-        }
-    }
-
-    field_list = ['campaign_name', 'campaign_description', '_score']
-    campaign_results = es.search(index=index, query=expansion_query, size=1, fields=field_list)
-    response_data = [{"_score": hit["_score"], **hit["_source"]} for hit in campaign_results["hits"]["hits"]]
-    documents = []
-    # Check if there are hits
-    if "hits" in campaign_results and "total" in campaign_results["hits"]:
-        total_hits = campaign_results["hits"]["total"]
-
-        # Check if there are any hits with a value greater than 0
-        if isinstance(total_hits, dict) and "value" in total_hits and total_hits["value"] > 0:
-            for hit in response_data:
-                if hit['_score'] > 5:
-                    doc_data = {field: hit[field] for field in field_list if field in hit}
-                    documents.append(doc_data)
-    return documents
-
-
 def calculate_cost(message):
     cost_per_1k_prompt = 0.03
     cost_per_1k_message = 0.06
@@ -291,17 +136,17 @@ def calculate_cost(message):
 #        start with the form and control flow
 # ------------------------------------------------
 
-image = Image.open('images/logo.png')
-
-st.image(image, width=200)
+st.image(load_logo(), width=200)
 
 if "chat_responses" not in st.session_state:
     st.session_state.chat_responses = []
+conversation = get_conversation(st.session_state)
 
 st.title('Financial services assistant')
 assistant_type = st.selectbox("Which feature do you want to use?",
                               ('Transaction analyser', 'Customer support', 'Report analyser'), key='assistant_type',
                               on_change=set_assistant_type)
+mark_first_paint('start')
 
 with st.form("search-form"):
     st.session_state.question = st.text_input("Go ahead and ask your question:",
@@ -318,107 +163,85 @@ with st.form("search-form"):
 
     submitted = st.form_submit_button("Submit")
 
+if st.button("Start a new conversation"):
+    conversation = reset_conversation(st.session_state)
+
 # -----------------------------------------------------------
 #        Search for context and interact with the LLM
 # -----------------------------------------------------------
 
 if submitted:
+    pd = lazy_import('pandas')
     # st.write(st.session_state.assistant_type)
-    if st.session_state.assistant_type == "Transaction analyser":
-        # run a transaction search
-        st.session_state.index = "search-transactions"
-        results = transaction_search_operation(st.session_state.index, st.session_state.question, days)
-        string_results = json.dumps(results)
-        df_results = pd.DataFrame(results)
-
-        # interact with the LLM
-        augmented_prompt = f"""Using only the contexts below, answer the query.
-        Contexts: {string_results}
-
-        Query: {st.session_state.question}"""
-        messages = [
-            SystemMessage(
-                content="You are a helpful financial analyst using transaction search results to give advice to customers. "
-                        "If you can asnwer a question, attempt to answer it fully. Assume the context provided provides an accurate response to the query."),
-            # HumanMessage(content="Hi AI, how are you today?"),
-            # AIMessage(content="I am great thank you. How can I help you today?"),
-            HumanMessage(content=augmented_prompt)
-        ]
-
-    elif st.session_state.assistant_type == 'Customer support':
-        st.session_state.index = "search-customer-support"
-        results = customer_support_search_operation(st.session_state.index, st.session_state.question)
-        string_results = json.dumps(results)
-        df_results = pd.DataFrame(results)
-        string_results = truncate_text(string_results, 10000)
-        # interact with the LLM
-        augmented_prompt = f"""Using only the context below, answer the query.
-        Context: {string_results}
-
-        Query: {st.session_state.question}"""
-        messages = [
-            SystemMessage(
-                content="You are a helpful customer support agent that answers questions based only on the context provided. "
-                        "When you respond, please cite your source."),
-            # HumanMessage(content="Hi AI, how are you today?"),
-            # AIMessage(content="I am very good. How may I help you?"),
-            HumanMessage(content=augmented_prompt)
-        ]
-    elif st.session_state.assistant_type == 'Report analyser':
-        st.session_state.index = "search-annual-reports"
-        results = report_analyser_search_operation(st.session_state.index, st.session_state.question, report_name)
-        string_results = json.dumps(results)
-        df_results = pd.DataFrame(results)
-        reduced_string_results = truncate_text(string_results, 8000)
-        # interact with the LLM
-        augmented_prompt = f"""Using only the context below, answer the query.
-        Context: {reduced_string_results}
-
-        Query: {st.session_state.question}"""
-        messages = [
-            SystemMessage(
-                content="You are a helpful analyst that answers questions based only on the context provided. "
-                        "When you respond, please cite your source and where possible, always summarise your answers."),
-            # HumanMessage(content="Hi AI, how are you today?"),
-            # AIMessage(content="I am very good. How may I help you?"),
-            HumanMessage(content=augmented_prompt)
-        ]
+    st.session_state.index = INDICES[st.session_state.assistant_type]
+    support_index = get_support_index(st.session_state.index) if SUPPORT_HOT_INDEX else None
+    results, reused_results = retrieve(
+        get_es(), support_index, conversation, st.session_state.assistant_type, st.session_state.question,
+        days=days if st.session_state.assistant_type == 'Transaction analyser' else None,
+        report_name=report_name if st.session_state.assistant_type == 'Report analyser' else None)
+    string_results = json.dumps(results)
+    df_results = pd.DataFrame(results)
+    # interact with the LLM
+    messages = chat_messages(build_prompt(conversation, st.session_state.assistant_type, st.session_state.question,
+                                          results))
+    if conversation["turns"]:
+        with st.expander('Conversation so far:'):
+            for line in conversation["summary"]:
+                st.write(line)
+            for turn in conversation["turns"]:
+                st.chat_message("user").write(turn["question"])
+                st.chat_message("ai assistant", avatar="🤖").write(turn["answer"])
     st.subheader('Virtual assistant:')
     chat_bot = st.chat_message("ai assistant", avatar="🤖")
     with st.status("Processing the data...") as status:
         result_len = len(df_results)
-        status.update(label=f'Retrieved {result_len} results from Elasticsearch', state="running")
-        current_chat_message = chat_model(messages).content
-        st.session_state.chat_responses = current_chat_message
-        status.update(label=f'Reaching out to LLM', state="running")
-        chat_bot.info(st.session_state.chat_responses)
-        cost_data = calculate_cost(st.session_state.chat_responses)
-        st.write(f"Calculating response cost: ${cost_data}")
-        status.update(label="AI response complete!", state="complete")
+        if reused_results:
+            status.update(label=f'Reusing {result_len} results from the previous search', state="running")
+        else:
+            status.update(label=f'Retrieved {result_len} results from Elasticsearch', state="running")
+        try:
+            current_chat_message, llm_stats = ask_llm(messages)
+        except default_retryable_errors() as error:
+            # the scheduler has used up its retries, the failed turn is not added to the conversation
+            llm_stats = getattr(error, 'llm_stats', {"queue_wait": 0.0, "attempts": 0})
+            chat_bot.error(llm_error_message(error, llm_stats))
+            status.update(label="The AI service is busy, please try again shortly", state="error")
+        else:
+            st.session_state.chat_responses = current_chat_message
+            add_turn(conversation, st.session_state.question, current_chat_message)
+            status.update(label=f'Reaching out to LLM', state="running")
+            chat_bot.info(st.session_state.chat_responses)
+            cost_data = calculate_cost(st.session_state.chat_responses)
+            st.write(f"Calculating response cost: ${cost_data}")
+            if llm_stats["coalesced"]:
+                st.write(f"Shared an identical in-flight request, queued {llm_stats['queue_wait']:.2f}s, "
+                         f"total wait {llm_stats['total_wait']:.2f}s")
+            else:
+                st.write(f"Waited {llm_stats['queue_wait']:.2f}s in the LLM queue")
+            status.update(label="AI response complete!", state="complete")
 
     # handle any context data that we want to represent
     if st.session_state.assistant_type == 'Transaction analyser':
 
-        campaigns = get_campaigns('search-campaigns', string_results)
+        campaigns = get_campaigns(get_es(), CAMPAIGN_INDEX, string_results)
         if len(campaigns):
             if opt_in:
-                campaign_string_results = json.dumps(campaigns)
                 df_campaigns = pd.DataFrame(campaigns)
                 # interact with the LLM
-                augmented_prompt = f"""Using the contexts below, explain to the customer about our special offers.
-                Contexts: {campaign_string_results}"""
-                messages = [
-                    SystemMessage(
-                        content="You are a helpful customer support representative that can enthusiastically explain how our special offers can help them. "
-                                "Do not simply repeat the special offer text, rephrase it to be positive and rewarding."
-                                "Respond in no more than 80 words."),
-                    HumanMessage(content=augmented_prompt)
-                ]
+                messages = chat_messages(campaign_prompt(campaigns))
                 campaign_chat_bot = st.chat_message("ai assistant", avatar="🤖")
                 with st.status("Contacting our experts...") as status:
-                    campaign_chat_bot.info(chat_model(messages).content)
-                    status.update(label="AI response complete!", state="complete")
+                    try:
+                        campaign_chat_bot.info(ask_llm(messages)[0])
+                    except default_retryable_errors() as error:
+                        llm_stats = getattr(error, 'llm_stats', {"queue_wait": 0.0, "attempts": 0})
+                        campaign_chat_bot.error(llm_error_message(error, llm_stats))
+                        status.update(label="The AI service is busy, please try again shortly", state="error")
+                    else:
+                        status.update(label="AI response complete!", state="complete")
                 st.subheader('Campaign data:')
                 st.dataframe(df_campaigns)
         st.subheader('Transactions:')
     st.dataframe(df_results)
+
+show_report(st)
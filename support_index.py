@@ -0,0 +1,157 @@
+import math
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+
+from profiler import lazy_import
+
+# ------------------------------------------
+#        in-process customer support index
+# ------------------------------------------
+
+# reload the corpus at least this often
+REFRESH_SECONDS = 900
+# how often to check Elasticsearch for added, updated or deleted documents
+CHANGE_CHECK_SECONDS = 60
+# share of the query's idf weight the best hit has to cover to be answered locally
+MIN_CONFIDENCE = 0.6
+K1 = 1.2
+B = 0.75
+STOPWORDS = {"a", "am", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "had",
+             "has", "have", "how", "i", "if", "in", "is", "it", "me", "my", "of", "on", "or", "so", "that", "the",
+             "this", "to", "was", "were", "what", "when", "where", "which", "who", "why", "will", "with", "you",
+             "your"}
+
+
+def tokenize(text):
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+
+def scan_documents(es, index):
+    helpers = lazy_import('elasticsearch.helpers')
+    return helpers.scan(es, index=index, query={"query": {"match_all": {}}}, _source=['title', 'body_content'])
+
+
+class SupportIndex:
+    """BM25 index over the customer support corpus, loaded once per process.
+
+    A background thread loads the corpus and, every change check interval,
+    reloads it when it is older than the refresh interval or when the document
+    count or indexing total of the Elasticsearch index changes. Searches only
+    read the loaded corpus and report whether the local answer is confident
+    enough, so the caller can fall back to the hybrid ELSER query. Until the
+    first load finishes every search falls back. The corpus is read with
+    scan(es, index), which yields hits with a _source.
+    """
+
+    def __init__(self, es, index, refresh_seconds=REFRESH_SECONDS, change_check_seconds=CHANGE_CHECK_SECONDS,
+                 min_confidence=MIN_CONFIDENCE, scan=scan_documents):
+        self.es = es
+        self.index = index
+        self.scan = scan
+        self.refresh_seconds = refresh_seconds
+        self.change_check_seconds = change_check_seconds
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._state = None
+        self._checked_at = -math.inf
+        self.stats = {"local": 0, "fallback": 0, "loads": 0}
+
+    def _fingerprint(self):
+        count = self.es.count(index=self.index)["count"]
+        stats = self.es.indices.stats(index=self.index, metric="indexing")
+        return count, stats["_all"]["primaries"]["indexing"]["index_total"]
+
+    def _build(self):
+        fingerprint = self._fingerprint()
+        documents = []
+        postings = {}
+        lengths = array('I')
+        for hit in self.scan(self.es, self.index):
+            source = hit["_source"]
+            doc_id = len(documents)
+            documents.append({field: source[field] for field in ('title', 'body_content') if field in source})
+            tokens = tokenize(f"{source.get('title', '')} {source.get('body_content', '')}")
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                if term not in postings:
+                    postings[term] = (array('I'), array('I'))
+                postings[term][0].append(doc_id)
+                postings[term][1].append(frequency)
+        total = len(documents)
+        idf = {term: math.log(1 + (total - len(ids) + 0.5) / (len(ids) + 0.5)) for term, (ids, _) in postings.items()}
+        return {
+            "documents": documents,
+            "postings": postings,
+            "lengths": lengths,
+            "average_length": (sum(lengths) / total) if total else 0,
+            "idf": idf,
+            "max_idf": math.log(1 + (total + 0.5) / 0.5),
+            "fingerprint": fingerprint,
+            "loaded_at": time.monotonic()
+        }
+
+    def _refresh(self):
+        # runs on a background thread, so searches never wait for Elasticsearch
+        try:
+            state = self._state
+            stale = state is None or time.monotonic() - state["loaded_at"] >= self.refresh_seconds
+            if stale or self._fingerprint() != state["fingerprint"]:
+                state = self._build()
+                with self._lock:
+                    self._state = state
+                    self.stats["loads"] += 1
+        except Exception:
+            # keep serving the previous corpus, searches fall back to Elasticsearch until a load succeeds
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _current(self):
+        now = time.monotonic()
+        with self._lock:
+            due = not self._refreshing and now - self._checked_at >= self.change_check_seconds
+            if due:
+                self._refreshing = True
+                self._checked_at = now
+            state = self._state
+        if due:
+            threading.Thread(target=self._refresh, daemon=True).start()
+        return state
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def search(self, question, size=20):
+        """Returns the top hits in the Elasticsearch result shape and whether they are confident."""
+        state = self._current()
+        terms = set(tokenize(question))
+        if state is None or not state["documents"] or not terms:
+            self._count("fallback")
+            return [], False
+        scores = {}
+        matched = {}
+        for term in terms:
+            if term not in state["postings"]:
+                continue
+            ids, frequencies = state["postings"][term]
+            idf = state["idf"][term]
+            for doc_id, frequency in zip(ids, frequencies):
+                norm = K1 * (1 - B + B * state["lengths"][doc_id] / state["average_length"])
+                scores[doc_id] = scores.get(doc_id, 0) + idf * frequency * (K1 + 1) / (frequency + norm)
+                matched[doc_id] = matched.get(doc_id, 0) + idf
+        if not scores:
+            self._count("fallback")
+            return [], False
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:size]
+        # unknown terms weigh as much as the rarest possible term
+        query_weight = sum(state["idf"].get(term, state["max_idf"]) for term in terms)
+        confident = matched[ranked[0][0]] / query_weight >= self.min_confidence
+        self._count("local" if confident else "fallback")
+        documents = [{**state["documents"][doc_id], "_score": score} for doc_id, score in ranked]
+        return documents, confident